@@ -1,23 +1,49 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime, timedelta, date
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 import random
+import bisect
+import heapq
 import json
 import uuid
-from collections import defaultdict
-from fastapi.responses import JSONResponse
+from collections import defaultdict, deque, OrderedDict
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi import BackgroundTasks
-import smtplib
+import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import aiosmtplib
 import os
+import hashlib
+import threading
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
-from prophet import Prophet
+import orjson
+
+if TYPE_CHECKING:
+    from prophet import Prophet
 
 load_dotenv()
 
-app = FastAPI(title="Microgreen Grower Portal API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Long-lived resources (defined further down): the forecast worker process and
+    # the dashboard refresher task. The SMTP session opens on the first send, so an
+    # unreachable mail host can't hold up startup; it is only closed here
+    start_forecast_executor()
+    await start_dashboard_refresher()
+    try:
+        yield
+    finally:
+        await stop_dashboard_refresher()
+        stop_forecast_executor()
+        await close_smtp_connection()
+
+app = FastAPI(title="Microgreen Grower Portal API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -53,7 +79,7 @@ class Harvest(BaseModel):
 
 # Inventory Module Models
 class InventoryItem(BaseModel):
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     variety: str
     trayCount: int
     harvestDate: datetime
@@ -61,27 +87,28 @@ class InventoryItem(BaseModel):
     status: str # "in-storage", "sold", "waste"
 
 class InventoryLog(BaseModel):
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     itemId: str
     change: int # +/- value
     reason: str
-    timestamp: datetime = datetime.now()
+    timestamp: datetime = Field(default_factory=datetime.now)
     userId: str = "system" # Placeholder
 
 # Order Module Models
 class OrderItem(BaseModel):
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     orderId: str
     inventoryItemId: str # Link to the specific batch
     variety: str # Denormalized for convenience
+    variety_id: Optional[int] = None # Resolved from variety on ingest
     quantity: int # Number of trays
     price_per_tray: Optional[float] = None
 
 class Order(BaseModel):
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     customerName: str
     customerContact: Optional[str] = None # e.g., email or phone
-    orderDate: datetime = datetime.now()
+    orderDate: datetime = Field(default_factory=datetime.now)
     pickupDate: datetime
     status: str = "pending" # "pending", "confirmed", "completed", "cancelled"
     items: List[OrderItem] = []
@@ -89,7 +116,7 @@ class Order(BaseModel):
 
 # NEW: Forecasting Module Models
 class SalesRecord(BaseModel): # For historical data if needed separately
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     date: date
     totalTraysSold: int
     revenue: Optional[float] = None
@@ -99,11 +126,11 @@ class ForecastPoint(BaseModel):
     predictedTrays: float
 
 class Forecast(BaseModel):
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     periodStart: date
     periodEnd: date
     predictions: List[ForecastPoint]
-    createdAt: datetime = datetime.now()
+    createdAt: datetime = Field(default_factory=datetime.now)
 
 # Notification Module Models
 class NotificationCreate(BaseModel):
@@ -111,49 +138,103 @@ class NotificationCreate(BaseModel):
     type: str  # e.g. "alert", "info"
 
 class Notification(BaseModel):
-    id: str = str(uuid.uuid4())
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     message: str
     type: str  # "alert", "info"
-    timestamp: datetime = datetime.now()
+    timestamp: datetime = Field(default_factory=datetime.now)
     is_read: bool = False
 
-# In-memory storage for notifications
-notifications: List[Notification] = []
+# In-memory storage for notifications, capped so the history can't grow without bound,
+# plus an index of the unread ones so the unread filter is O(unread)
+MAX_NOTIFICATIONS = 10000
+notifications: "deque[Notification]" = deque(maxlen=MAX_NOTIFICATIONS)
+unread_notifs: Dict[str, Notification] = {}
+
+def add_notification(notif: Notification):
+    if len(notifications) == notifications.maxlen:
+        unread_notifs.pop(notifications[0].id, None)
+    notifications.append(notif)
+    if not notif.is_read:
+        unread_notifs[notif.id] = notif
+
+# Shared SMTP session for notification emails. Opening a new TCP+TLS+AUTH
+# handshake per alert is slow, so one connection is opened on the first send, kept,
+# and reopened when dropped
+class SMTPConnection:
+    def __init__(self):
+        self.smtp: Optional[aiosmtplib.SMTP] = None
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def settings() -> Optional[dict]:
+        settings = {
+            "host": os.getenv("SMTP_HOST"),
+            "port": int(os.getenv("SMTP_PORT", 587)),
+            "user": os.getenv("SMTP_USER"),
+            "password": os.getenv("SMTP_PASS"),
+            "email_from": os.getenv("EMAIL_FROM"),
+            "email_to": os.getenv("EMAIL_TO"),
+        }
+        if not all(settings.values()):
+            return None
+        return settings
+
+    async def _ensure_connected(self, settings: dict) -> aiosmtplib.SMTP:
+        if self.smtp is None or not self.smtp.is_connected:
+            smtp = aiosmtplib.SMTP(hostname=settings["host"], port=settings["port"], start_tls=True)
+            await smtp.connect()
+            await smtp.login(settings["user"], settings["password"])
+            self.smtp = smtp
+        return self.smtp
+
+    async def sendmail(self, settings: dict, message: str):
+        async with self.lock:
+            try:
+                smtp = await self._ensure_connected(settings)
+                await smtp.sendmail(settings["email_from"], settings["email_to"], message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Idle connection was closed by the server; reconnect once and retry
+                self.smtp = None
+                smtp = await self._ensure_connected(settings)
+                await smtp.sendmail(settings["email_from"], settings["email_to"], message)
+
+    async def close(self):
+        async with self.lock:
+            if self.smtp is not None and self.smtp.is_connected:
+                await self.smtp.quit()
+            self.smtp = None
+
+smtp_connection = SMTPConnection()
+
+async def close_smtp_connection():
+    try:
+        await smtp_connection.close()
+    except Exception as e:
+        print(f"Failed to close SMTP connection: {e}")
 
 # Helper to send notification emails
-def send_email_notification(subject: str, body: str):
-    smtp_host = os.getenv("SMTP_HOST")
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_pass = os.getenv("SMTP_PASS")
-    email_from = os.getenv("EMAIL_FROM")
-    email_to = os.getenv("EMAIL_TO")
-    if not all([smtp_host, smtp_user, smtp_pass, email_from, email_to]):
+async def send_email_notification(subject: str, body: str):
+    settings = SMTPConnection.settings()
+    if settings is None:
         print("Email settings not configured. Skipping email notification.")
         return
     try:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_pass)
-            message = f"Subject: {subject}\n\n{body}"
-            server.sendmail(email_from, email_to, message)
+        await smtp_connection.sendmail(settings, f"Subject: {subject}\n\n{body}")
     except Exception as e:
         print(f"Failed to send email: {e}")
 
 @app.get("/notifications", response_model=List[Notification])
-def get_notifications(unread: Optional[bool] = None):
+async def get_notifications(unread: Optional[bool] = None):
     # Return all notifications or filter to only unread
     if unread:
-        return [n for n in notifications if not n.is_read]
-    return notifications
+        return list(unread_notifs.values())
+    return list(notifications)
 
 @app.post("/notifications", response_model=Notification, status_code=201)
-def create_notification(notification_data: NotificationCreate, background_tasks: BackgroundTasks):
+async def create_notification(notification_data: NotificationCreate, background_tasks: BackgroundTasks):
     # Create a new notification and enqueue email if it's an alert
-    new_id = str(uuid.uuid4())
-    now = datetime.now()
-    new_notif = Notification(id=new_id, message=notification_data.message, type=notification_data.type, timestamp=now)
-    notifications.append(new_notif)
+    new_notif = Notification(message=notification_data.message, type=notification_data.type)
+    add_notification(new_notif)
     if notification_data.type == "alert":
         background_tasks.add_task(
             send_email_notification,
@@ -163,11 +244,15 @@ def create_notification(notification_data: NotificationCreate, background_tasks:
     return new_notif
 
 @app.put("/notifications/{notification_id}/read", response_model=Notification)
-def mark_notification_read(notification_id: str):
+async def mark_notification_read(notification_id: str):
     # Mark an existing notification as read
+    notif = unread_notifs.pop(notification_id, None)
+    if notif is not None:
+        notif.is_read = True
+        return notif
+    # Already read (or unknown): fall back to the full history
     for notif in notifications:
         if notif.id == notification_id:
-            notif.is_read = True
             return notif
     raise HTTPException(status_code=404, detail="Notification not found")
 
@@ -183,32 +268,93 @@ varieties = [
     {"id": 6, "name": "Kale", "grow_cycle_days": 10, "expected_yield_per_tray": 160.0},
     {"id": 7, "name": "Wheatgrass", "grow_cycle_days": 12, "expected_yield_per_tray": 210.0},
 ]
-
-# Generate mock plantings
-plantings = []
-for i in range(1, 40):
-    variety = random.choice(varieties)
-    plant_date = datetime.now() - timedelta(days=random.randint(0, 60))
-    expected_harvest_date = plant_date + timedelta(days=variety["grow_cycle_days"])
-    status = random.choice(["planted", "growing", "growing", "harvested", "failed"])
-    if status == "harvested" and expected_harvest_date > datetime.now(): status = "growing"
-    if status == "growing" and expected_harvest_date < datetime.now(): status = "harvested"
-    if status == "planted" and plant_date < datetime.now() - timedelta(days=3): status = "growing"
-    
-    plantings.append({
+variety_by_id = {v["id"]: v for v in varieties}
+variety_by_name = {v["name"]: v for v in varieties}
+# Dense 0..n-1 slot per variety, for array-based aggregation
+variety_slot = {v["id"]: slot for slot, v in enumerate(varieties)}
+
+# Generate mock plantings (drawn as arrays, then unpacked into dicts)
+rng = np.random.default_rng()
+n_plantings = 39
+now64 = np.datetime64(datetime.now(), "us")
+variety_picks = rng.integers(0, len(varieties), n_plantings)
+cycle_days = np.array([v["grow_cycle_days"] for v in varieties])[variety_picks]
+plant_dates = now64 - rng.integers(0, 61, n_plantings).astype("timedelta64[D]")
+expected_harvest_dates = plant_dates + cycle_days.astype("timedelta64[D]")
+statuses = rng.choice(["planted", "growing", "growing", "harvested", "failed"], n_plantings)
+statuses = np.where((statuses == "harvested") & (expected_harvest_dates > now64), "growing", statuses)
+statuses = np.where((statuses == "growing") & (expected_harvest_dates < now64), "harvested", statuses)
+statuses = np.where((statuses == "planted") & (plant_dates < now64 - np.timedelta64(3, "D")), "growing", statuses)
+tray_counts = rng.integers(1, 6, n_plantings)
+
+plantings = [
+    {
         "id": i,
-        "variety_id": variety["id"],
+        "variety_id": varieties[variety_idx]["id"],
         "plant_date": plant_date,
         "expected_harvest_date": expected_harvest_date,
         "status": status,
-        "tray_count": random.randint(1, 5)
-    })
+        "tray_count": tray_count
+    }
+    for i, (variety_idx, plant_date, expected_harvest_date, status, tray_count) in enumerate(
+        zip(variety_picks.tolist(), plant_dates.tolist(), expected_harvest_dates.tolist(), statuses.tolist(), tray_counts.tolist()),
+        start=1,
+    )
+]
+
+planting_by_id = {p["id"]: p for p in plantings}
+class PlantingColumns:
+    # Date and status columns aligned with `plantings` by position, so status refreshes
+    # don't rebuild them per request. Backed by buffers that double when full, so
+    # appends are amortized O(1); readers only see the live [:n] views
+    def __init__(self, plant_dates: np.ndarray, expected_dates: np.ndarray, statuses: np.ndarray):
+        self.n = len(statuses)
+        capacity = max(64, 2 * self.n)
+        self._plant_dates = np.empty(capacity, dtype="datetime64[s]")
+        self._expected_dates = np.empty(capacity, dtype="datetime64[s]")
+        self._statuses = np.empty(capacity, dtype="<U9")
+        self._plant_dates[:self.n] = plant_dates
+        self._expected_dates[:self.n] = expected_dates
+        self._statuses[:self.n] = statuses
+
+    @property
+    def plant_dates(self) -> np.ndarray:
+        return self._plant_dates[:self.n]
+
+    @property
+    def expected_dates(self) -> np.ndarray:
+        return self._expected_dates[:self.n]
+
+    @property
+    def statuses(self) -> np.ndarray:
+        # A view, so writes through it update the buffer
+        return self._statuses[:self.n]
+
+    def append(self, plant_date: datetime, expected_date: datetime, status: str):
+        if self.n == len(self._statuses):
+            capacity = 2 * len(self._statuses)
+            self._plant_dates = np.resize(self._plant_dates, capacity)
+            self._expected_dates = np.resize(self._expected_dates, capacity)
+            self._statuses = np.resize(self._statuses, capacity)
+        self._plant_dates[self.n] = np.datetime64(plant_date, "s")
+        self._expected_dates[self.n] = np.datetime64(expected_date, "s")
+        self._statuses[self.n] = status
+        self.n += 1
+
+# Extended by index_planting, statuses updated by refresh_planting_statuses
+planting_columns = PlantingColumns(plant_dates, expected_harvest_dates, statuses)
+
+def index_planting(planting: dict):
+    planting_by_id[planting["id"]] = planting
+    planting_columns.append(planting["plant_date"], planting["expected_harvest_date"], planting["status"])
+
+_next_planting_id = max((p["id"] for p in plantings), default=0) + 1
 
 # Generate mock harvests
 harvests = []
 for planting in plantings:
     if planting["status"] == "harvested":
-        variety = next((v for v in varieties if v["id"] == planting["variety_id"]), None)
+        variety = variety_by_id.get(planting["variety_id"])
         if not variety: continue
         expected_yield = variety["expected_yield_per_tray"] * planting["tray_count"]
         actual_yield = expected_yield * random.uniform(0.75, 1.10)
@@ -222,13 +368,26 @@ for planting in plantings:
             "quality_score": random.randint(6, 10)
         })
 
+# Harvests joined to their planting's variety slot and tray count, one typed column
+# per field so the dashboard aggregates contiguous arrays. Harvests are only
+# recorded here at startup, so the frame never needs to be kept in sync
+harvest_plantings = [planting_by_id[h["planting_id"]] for h in harvests]
+harvests_df = pd.DataFrame(
+    {
+        "harvest_date": pd.to_datetime([h["harvest_date"] for h in harvests]),
+        "actual_yield": np.array([h["actual_yield"] for h in harvests], dtype=np.float64),
+        "variety_slot": np.array([variety_slot[p["variety_id"]] for p in harvest_plantings], dtype=np.int64),
+        "tray_count": np.array([p["tray_count"] for p in harvest_plantings], dtype=np.float64),
+    },
+    index=pd.Index([h["id"] for h in harvests], name="id"),
+)
+
 # Generate mock inventory items based on harvests
 inventory_items = []
 inventory_logs = []
-for harvest in harvests:
-    planting = next((p for p in plantings if p["id"] == harvest["planting_id"]), None)
-    if not planting: continue
-    variety = next((v for v in varieties if v["id"] == planting["variety_id"]), None)
+# Reuse the planting join from above: one lookup and one guard per harvest
+for harvest, planting in zip(harvests, harvest_plantings):
+    variety = variety_by_id.get(planting["variety_id"])
     if not variety: continue
     item_id = str(uuid.uuid4())
     
@@ -252,8 +411,22 @@ for harvest in harvests:
     }
     inventory_logs.append(log)
 
-# Generate mock orders
-orders = []
+# Lookup indexes (id -> position in list, variety -> positions), kept in sync on insert/update/delete
+inventory_by_id = {}
+inventory_by_variety = {}
+
+def rebuild_inventory_indexes():
+    inventory_by_id.clear()
+    inventory_by_variety.clear()
+    for idx, item in enumerate(inventory_items):
+        inventory_by_id[item["id"]] = idx
+        inventory_by_variety.setdefault(item["variety"], []).append(idx)
+
+rebuild_inventory_indexes()
+orders_by_id = {}
+
+# Generate mock orders (stored as validated Order models)
+orders: List[Order] = []
 for i in range(1, 35):
     order_id = str(uuid.uuid4())
     order_date = datetime.now() - timedelta(days=random.randint(0, 60))
@@ -271,7 +444,8 @@ for i in range(1, 35):
     
     for _ in range(random.randint(1, 3)):
         if not available_inventory: break
-        inventory_item_ref = next((item for item in inventory_items if item["id"] == available_inventory[0]["id"]), None)
+        inv_idx_live = inventory_by_id.get(available_inventory[0]["id"])
+        inventory_item_ref = inventory_items[inv_idx_live] if inv_idx_live is not None else None
         if not inventory_item_ref or inventory_item_ref["trayCount"] <= 0: 
             available_inventory.pop(0)
             continue # Skip if somehow ref lost or count is zero
@@ -281,21 +455,19 @@ for i in range(1, 35):
         price_per = random.uniform(8.0, 12.0)
         
         order_item = OrderItem(
-            id=str(uuid.uuid4()),
             orderId=order_id,
             inventoryItemId=inventory_item["id"],
             variety=inventory_item["variety"],
+            variety_id=variety_by_name[inventory_item["variety"]]["id"],
             quantity=quantity_to_order,
             price_per_tray=round(price_per, 2)
         )
-        order_items_list.append(order_item.dict())
+        order_items_list.append(order_item)
         total_order_price += order_item.quantity * (order_item.price_per_tray or 0)
         
         # Simulate inventory decrease IF order is not cancelled
         if status != "cancelled":
             try:
-                # Find index again to modify the actual list item
-                inv_idx_live = next((idx for idx, inv in enumerate(inventory_items) if inv["id"] == inventory_item["id"]), None)
                 if inv_idx_live is not None:
                     inventory_items[inv_idx_live]["trayCount"] -= quantity_to_order
                     log = InventoryLog(itemId=inventory_item["id"], change=-quantity_to_order, reason=f"Order {order_id} ({status})")
@@ -312,10 +484,117 @@ for i in range(1, 35):
         orderDate=order_date,
         pickupDate=pickup_date,
         status=status,
-        items=[OrderItem(**item) for item in order_items_list],
+        items=order_items_list,
         total_price=round(total_order_price, 2)
     )
-    orders.append(order.dict())
+    orders_by_id[order_id] = len(orders)
+    orders.append(order)
+
+class OrderSalesColumns:
+    # One row per order so historical sales can be aggregated column-wise; rows line up
+    # with `orders` by position and are kept in sync by create_order and update_order_status.
+    # Writes only touch plain lists, and the DataFrame is rebuilt on the first read after
+    # a change, so inserting an order doesn't copy the whole frame
+    def __init__(self, orders: List[Order]):
+        self.ids = [o.id for o in orders]
+        self.order_dates = [o.orderDate for o in orders]
+        self.quantities = [sum(item.quantity for item in o.items) for o in orders]
+        self.statuses = [o.status for o in orders]
+        self._frame: Optional[pd.DataFrame] = None
+
+    def append(self, order: Order):
+        self.ids.append(order.id)
+        self.order_dates.append(order.orderDate)
+        self.quantities.append(sum(item.quantity for item in order.items))
+        self.statuses.append(order.status)
+        self._frame = None
+
+    def set_status(self, index: int, status: str):
+        self.statuses[index] = status
+        self._frame = None
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            self._frame = pd.DataFrame(
+                {
+                    "orderDate": pd.to_datetime(self.order_dates),
+                    "quantity": self.quantities,
+                    "status": self.statuses,
+                },
+                index=pd.Index(self.ids, name="id"),
+            )
+        return self._frame
+
+order_sales = OrderSalesColumns(orders)
+
+# --- Running Dashboard KPIs ---
+
+RECENT_WINDOW = timedelta(days=30)
+
+# Bumped by every write that can change the dashboard, so a cached payload knows it is stale
+_data_version = 0
+
+def bump_data_version():
+    global _data_version
+    _data_version += 1
+
+class KPIState:
+    # Dashboard totals, seeded once from the mock data and then kept current by
+    # the write paths so the dashboard doesn't rescan every list per request
+    def __init__(self):
+        self.growing_trays = sum(p["tray_count"] for p in plantings if p["status"] in ["planted", "growing"])
+        self.storage_trays = sum(i["trayCount"] for i in inventory_items if i["status"] == "in-storage")
+        self.total_yield = sum(h["actual_yield"] for h in harvests)
+        harvested_ids = {h["planting_id"] for h in harvests}
+        self.harvested_trays = sum(p["tray_count"] for p in plantings if p["id"] in harvested_ids)
+        # (orderDate, order id) of orders inside the window, oldest first
+        cutoff = datetime.now() - RECENT_WINDOW
+        recent = sorted((o for o in orders if o.orderDate > cutoff), key=lambda o: o.orderDate)
+        self.recent_orders = deque((o.orderDate, o.id) for o in recent)
+        # Orders dated at or before this have been evicted (or were never tracked)
+        self.window_start = cutoff
+        self.recent_revenue = sum(o.total_price or 0 for o in recent if o.status != "cancelled")
+        self.recent_order_count = sum(1 for o in recent if o.status != "cancelled")
+
+    def evict_expired(self):
+        # Eviction reads each order's current status, so callers changing a status
+        # must evict first; otherwise an expired order is evicted under its new status
+        cutoff = datetime.now() - RECENT_WINDOW
+        self.window_start = cutoff
+        while self.recent_orders and self.recent_orders[0][0] <= cutoff:
+            _, order_id = self.recent_orders.popleft()
+            order = orders[orders_by_id[order_id]]
+            if order.status != "cancelled":
+                self.recent_revenue -= order.total_price or 0
+                self.recent_order_count -= 1
+
+    def recent_totals(self) -> Tuple[float, int]:
+        self.evict_expired()
+        return self.recent_revenue, self.recent_order_count
+
+    def order_created(self, order: Order):
+        # New orders are stamped with the current time, so they are always the newest entry
+        self.recent_orders.append((order.orderDate, order.id))
+        if order.status != "cancelled":
+            self.recent_revenue += order.total_price or 0
+            self.recent_order_count += 1
+
+    def order_status_changed(self, order: Order, original_status: str):
+        # Only orders still in the window count; call evict_expired() before changing
+        # order.status, and don't evict again here so the two stay consistent
+        if order.orderDate <= self.window_start:
+            return
+        was_counted = original_status != "cancelled"
+        is_counted = order.status != "cancelled"
+        if was_counted and not is_counted:
+            self.recent_revenue -= order.total_price or 0
+            self.recent_order_count -= 1
+        elif is_counted and not was_counted:
+            self.recent_revenue += order.total_price or 0
+            self.recent_order_count += 1
+
+kpis = KPIState()
 
 # --- Helper Function for Inventory Adjustment ---
 
@@ -325,99 +604,146 @@ try:
 except ValueError:
     low_stock_threshold = 5
 
-def adjust_inventory(item_id: str, change: int, reason: str, user_id: str = "system"):
-    index = next((i for i, item in enumerate(inventory_items) if item["id"] == item_id), None)
-    if index is None:
-        raise HTTPException(status_code=404, detail=f"Inventory item {item_id} not found for adjustment")
-
-    current_count = inventory_items[index]["trayCount"]
-    new_count = current_count + change
-
-    if new_count < 0:
-        raise HTTPException(status_code=400, detail=f"Adjustment for item {item_id} results in negative inventory ({new_count}) for reason: {reason}")
+# Low stock alerts fire once when an item crosses below the threshold, and at most
+# once per variety per cooldown window
+LOW_STOCK_ALERT_COOLDOWN = timedelta(hours=1)
+last_low_stock_alert: Dict[str, datetime] = {}
+
+def adjust_inventory(item_id: str, change: int, reason: str, user_id: str = "system", background_tasks: Optional[BackgroundTasks] = None):
+    adjust_inventory_bulk([(item_id, change, reason)], user_id, background_tasks)
+
+def adjust_inventory_bulk(changes: List[Tuple[str, int, str]], user_id: str = "system", background_tasks: Optional[BackgroundTasks] = None):
+    # Validate every (item_id, change, reason) first so a failing batch leaves inventory untouched
+    original_counts = {}
+    new_counts = {}
+    for item_id, change, reason in changes:
+        index = inventory_by_id.get(item_id)
+        if index is None:
+            raise HTTPException(status_code=404, detail=f"Inventory item {item_id} not found for adjustment")
+        original_count = original_counts.setdefault(item_id, inventory_items[index]["trayCount"])
+        new_count = new_counts.get(item_id, original_count) + change
+        if new_count < 0:
+            raise HTTPException(status_code=400, detail=f"Adjustment for item {item_id} results in negative inventory ({new_count}) for reason: {reason}")
+        new_counts[item_id] = new_count
+
+    now = datetime.now() # Log time of adjustment
+    decreased = {}
+    for item_id, change, reason in changes:
+        item = inventory_items[inventory_by_id[item_id]]
+        item["trayCount"] += change
+        if item["status"] == "in-storage":
+            kpis.storage_trays += change
+        if change < 0:
+            decreased[item_id] = True
+        print(f"Inventory Adjusted: Item {item_id}, Change {change}, Reason: {reason}, New Count: {item['trayCount']}")
+    inventory_logs.extend([
+        InventoryLog(itemId=item_id, change=change, reason=reason, userId=user_id, timestamp=now).dict()
+        for item_id, change, reason in changes
+    ])
+    bump_data_version()
 
-    inventory_items[index]["trayCount"] = new_count
-    
-    log_entry = InventoryLog(
-        itemId=item_id,
-        change=change,
-        reason=reason,
-        userId=user_id,
-        timestamp=datetime.now() # Log time of adjustment
-    )
-    inventory_logs.append(log_entry.dict())
-    print(f"Inventory Adjusted: Item {item_id}, Change {change}, Reason: {reason}, New Count: {new_count}")
-    
     # Low stock alert when inventory falls below threshold
-    if change < 0 and new_count < low_stock_threshold:
-        alert_msg = f"Low inventory: {inventory_items[index]['variety']} down to {new_count} trays"
+    alerts = []
+    for item_id in decreased:
+        new_count = new_counts[item_id]
+        if not (original_counts[item_id] >= low_stock_threshold > new_count):
+            continue # Only alert on the transition into low stock
+        variety = inventory_items[inventory_by_id[item_id]]["variety"]
+        last_alert = last_low_stock_alert.get(variety)
+        if last_alert is not None and now - last_alert < LOW_STOCK_ALERT_COOLDOWN:
+            continue
+        last_low_stock_alert[variety] = now
+        alert_msg = f"Low inventory: {variety} down to {new_count} trays"
         # In-app notification
-        notif = Notification(id=str(uuid.uuid4()), message=alert_msg, type="alert", timestamp=datetime.now())
-        notifications.append(notif)
-        # Email alert
-        send_email_notification(f"Inventory Alert: {inventory_items[index]['variety']}", alert_msg)
+        add_notification(Notification(message=alert_msg, type="alert", timestamp=now))
+        alerts.append((variety, alert_msg))
+    # One email for the whole batch (sent after the response so the event loop isn't held up)
+    if alerts and background_tasks is not None:
+        subject = f"Inventory Alert: {alerts[0][0]}" if len(alerts) == 1 else f"Inventory Alert: {len(alerts)} items low"
+        background_tasks.add_task(send_email_notification, subject, "\n".join(msg for _, msg in alerts))
 
 # --- API Routes ---
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to the Microgreen Grower Portal API"}
 
 @app.get("/varieties")
-def get_varieties():
+async def get_varieties():
     return varieties
 
+# Lifecycle order of the statuses a planting advances through on its own
+PLANTING_STAGES = np.array(["planted", "growing", "ready"])
+
+def refresh_planting_statuses(now: datetime) -> bool:
+    """Advance planted/growing plantings whose dates have passed. Returns True if any changed."""
+    if not plantings:
+        return False
+    now64 = np.datetime64(now, "s")
+    current = planting_columns.statuses
+    # Same rules as create_planting, evaluated for every planting at once
+    derived_stage = np.where(
+        planting_columns.expected_dates <= now64, 2,
+        np.where(planting_columns.plant_dates < now64 - np.timedelta64(1, "D"), 1, 0),
+    )
+    current_stage = np.where(current == "growing", 1, 0)
+    # Only move forward, and leave harvested/ready plantings alone
+    changed = np.flatnonzero(((current == "planted") | (current == "growing")) & (derived_stage > current_stage))
+    if changed.size == 0:
+        return False
+    for i, stage in zip(changed.tolist(), derived_stage[changed].tolist()):
+        p = plantings[i]
+        p["status"] = PLANTING_STAGES[stage].item()
+        current[i] = p["status"]
+        if stage == 2:
+            kpis.growing_trays -= p["tray_count"]
+    bump_data_version()
+    return True
+
 @app.get("/plantings")
-def get_plantings():
-    # Update status for ready plantings
-    for p in plantings:
-        if p["status"] == "growing" and p["expected_harvest_date"] <= datetime.now():
-            p["status"] = "ready"
+async def get_plantings():
+    refresh_planting_statuses(datetime.now())
     return plantings
 
 @app.get("/harvests")
-def get_harvests():
+async def get_harvests():
     return harvests
 
 # --- Inventory API Routes ---
 
 @app.get("/inventory", response_model=List[InventoryItem])
-def get_inventory_items(
+async def get_inventory_items(
     variety: Optional[str] = None,
     status: Optional[str] = None,
-    start_date: Optional[str] = None, 
-    end_date: Optional[str] = None
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
 ):
-    filtered_items = inventory_items
-    
+    # Narrow by variety through the index, then apply the remaining filters in one pass
     if variety:
-        filtered_items = [item for item in filtered_items if item["variety"] == variety]
+        candidates = [inventory_items[idx] for idx in inventory_by_variety.get(variety, [])]
+    else:
+        candidates = inventory_items
+    preds = []
     if status:
-        filtered_items = [item for item in filtered_items if item["status"] == status]
+        preds.append(lambda item: item["status"] == status)
     if start_date:
-        try:
-            start_dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-            filtered_items = [item for item in filtered_items if item["harvestDate"] >= start_dt]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid start_date format")
+        preds.append(lambda item: item["harvestDate"] >= start_date)
     if end_date:
-        try:
-            end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-            filtered_items = [item for item in filtered_items if item["harvestDate"] <= end_dt]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid end_date format")
+        preds.append(lambda item: item["harvestDate"] <= end_date)
+    filtered_items = [item for item in candidates if all(p(item) for p in preds)]
             
-    return [InventoryItem(**item) for item in filtered_items]
+    # response_model validates and serializes the stored dicts in one pass
+    return filtered_items
 
 @app.get("/inventory/{item_id}", response_model=InventoryItem)
-def get_inventory_item(item_id: str):
-    item = next((item for item in inventory_items if item["id"] == item_id), None)
-    if not item:
+async def get_inventory_item(item_id: str):
+    index = inventory_by_id.get(item_id)
+    if index is None:
         raise HTTPException(status_code=404, detail="Inventory item not found")
-    return InventoryItem(**item)
+    return InventoryItem(**inventory_items[index])
 
 @app.post("/inventory", response_model=InventoryItem, status_code=201)
-def create_inventory_item(item_data: InventoryItem):
+async def create_inventory_item(item_data: InventoryItem, background_tasks: BackgroundTasks):
     if item_data.trayCount < 0:
         raise HTTPException(status_code=400, detail="Tray count cannot be negative")
     if item_data.status not in ["in-storage", "sold", "waste"]:
@@ -426,13 +752,18 @@ def create_inventory_item(item_data: InventoryItem):
     item_dict = item_data.dict()
     item_dict["id"] = str(uuid.uuid4())
     item_dict["harvestDate"] = datetime.now() # Set harvest date on manual creation?
+    inventory_by_id[item_dict["id"]] = len(inventory_items)
+    inventory_by_variety.setdefault(item_dict["variety"], []).append(len(inventory_items))
     inventory_items.append(item_dict)
-    adjust_inventory(item_dict["id"], item_data.trayCount, "Manual creation")
+    if item_dict["status"] == "in-storage":
+        kpis.storage_trays += item_dict["trayCount"]
+        bump_data_version()
+    adjust_inventory(item_dict["id"], item_data.trayCount, "Manual creation", background_tasks=background_tasks)
     return InventoryItem(**item_dict)
 
 @app.put("/inventory/{item_id}", response_model=InventoryItem)
-def update_inventory_item(item_id: str, updated_item_data: InventoryItem):
-    index = next((i for i, item in enumerate(inventory_items) if item["id"] == item_id), None)
+async def update_inventory_item(item_id: str, updated_item_data: InventoryItem):
+    index = inventory_by_id.get(item_id)
     if index is None:
         raise HTTPException(status_code=404, detail="Inventory item not found")
     
@@ -441,33 +772,44 @@ def update_inventory_item(item_id: str, updated_item_data: InventoryItem):
         
     original_item = inventory_items[index]
     update_data = updated_item_data.dict(exclude_unset=True)
+    update_data.pop("id", None) # The id is fixed; the indexes are keyed on it
     
     if "trayCount" in update_data and update_data["trayCount"] != original_item["trayCount"]:
         raise HTTPException(status_code=400, detail="Tray count must be updated via logs")
         
     updated_item_dict = {**original_item, **update_data}
     inventory_items[index] = updated_item_dict
+    was_stored = original_item["status"] == "in-storage"
+    is_stored = updated_item_dict["status"] == "in-storage"
+    if was_stored != is_stored:
+        kpis.storage_trays += updated_item_dict["trayCount"] if is_stored else -updated_item_dict["trayCount"]
+        bump_data_version()
+    if updated_item_dict["variety"] != original_item["variety"]:
+        inventory_by_variety[original_item["variety"]].remove(index)
+        bisect.insort(inventory_by_variety.setdefault(updated_item_dict["variety"], []), index)
     return InventoryItem(**updated_item_dict)
 
 @app.delete("/inventory/{item_id}", status_code=204)
-def delete_inventory_item(item_id: str):
+async def delete_inventory_item(item_id: str, background_tasks: BackgroundTasks):
     global inventory_items
-    index = next((i for i, item in enumerate(inventory_items) if item["id"] == item_id), None)
+    index = inventory_by_id.get(item_id)
     if index is None:
          raise HTTPException(status_code=404, detail="Inventory item not found")
          
     # Log the removal as waste or adjustment to zero before deleting?
-    adjust_inventory(item_id, -inventory_items[index]["trayCount"], "Item deleted")
+    adjust_inventory(item_id, -inventory_items[index]["trayCount"], "Item deleted", background_tasks=background_tasks)
     inventory_items.pop(index)
+    # Items after the removed one shift down by a position
+    rebuild_inventory_indexes()
     return
 
 @app.post("/inventory/{item_id}/log", response_model=InventoryLog, status_code=201)
-def create_inventory_log(item_id: str, log_entry_data: InventoryLog):
+async def create_inventory_log(item_id: str, log_entry_data: InventoryLog, background_tasks: BackgroundTasks):
     if log_entry_data.itemId != item_id:
          raise HTTPException(status_code=400, detail="Log entry itemId must match path item_id")
     
     # Use the helper function to handle adjustment and logging
-    adjust_inventory(item_id, log_entry_data.change, log_entry_data.reason, log_entry_data.userId)
+    adjust_inventory(item_id, log_entry_data.change, log_entry_data.reason, log_entry_data.userId, background_tasks)
     
     created_log = next((log for log in reversed(inventory_logs) if log["itemId"] == item_id and log["reason"] == log_entry_data.reason), None)
     if not created_log:
@@ -476,72 +818,48 @@ def create_inventory_log(item_id: str, log_entry_data: InventoryLog):
     return InventoryLog(**created_log)
     
 @app.get("/inventory/{item_id}/logs", response_model=List[InventoryLog])
-def get_inventory_item_logs(item_id: str):
-    if not any(item["id"] == item_id for item in inventory_items):
+async def get_inventory_item_logs(item_id: str):
+    if item_id not in inventory_by_id:
         raise HTTPException(status_code=404, detail="Inventory item not found")
         
-    item_logs = [log for log in inventory_logs if log["itemId"] == item_id]
-    return [InventoryLog(**log) for log in item_logs]
+    return [log for log in inventory_logs if log["itemId"] == item_id]
 
 
 # --- Order API Routes ---
 
 @app.get("/orders", response_model=List[Order])
-def get_orders_list(
+async def get_orders_list(
     status: Optional[str] = None,
-    start_date: Optional[str] = None,
-    end_date: Optional[str] = None,
-    pickup_start_date: Optional[str] = None,
-    pickup_end_date: Optional[str] = None
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    pickup_start_date: Optional[datetime] = None,
+    pickup_end_date: Optional[datetime] = None
 ):
-    filtered_orders = orders
+    # Collect the active filters and apply them in a single pass
+    preds = []
     if status:
-        filtered_orders = [o for o in filtered_orders if o["status"] == status]
+        preds.append(lambda o: o.status == status)
     if start_date:
-        try:
-            start_dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-            filtered_orders = [o for o in filtered_orders if o["orderDate"] >= start_dt]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid start_date format")
+        preds.append(lambda o: o.orderDate >= start_date)
     if end_date:
-        try:
-            end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-            filtered_orders = [o for o in filtered_orders if o["orderDate"] <= end_dt]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid end_date format")
+        preds.append(lambda o: o.orderDate <= end_date)
     # Apply pickup date filters
     if pickup_start_date:
-        try:
-            ps_dt = datetime.fromisoformat(pickup_start_date.replace('Z', '+00:00'))
-            filtered_orders = [o for o in filtered_orders if o["pickupDate"] >= ps_dt]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid pickup_start_date format")
+        preds.append(lambda o: o.pickupDate >= pickup_start_date)
     if pickup_end_date:
-        try:
-            pe_dt = datetime.fromisoformat(pickup_end_date.replace('Z', '+00:00'))
-            filtered_orders = [o for o in filtered_orders if o["pickupDate"] <= pe_dt]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid pickup_end_date format")
-            
-    result = []
-    for order_dict in filtered_orders:
-        order_copy = order_dict.copy()
-        order_copy["items"] = [OrderItem(**item) for item in order_dict["items"]]
-        result.append(Order(**order_copy))
-    return result
+        preds.append(lambda o: o.pickupDate <= pickup_end_date)
+    filtered_orders = [o for o in orders if all(p(o) for p in preds)]
+    return filtered_orders
 
 @app.get("/orders/{order_id}", response_model=Order)
-def get_order_details(order_id: str):
-    order_dict = next((o for o in orders if o["id"] == order_id), None)
-    if not order_dict:
+async def get_order_details(order_id: str):
+    index = orders_by_id.get(order_id)
+    if index is None:
         raise HTTPException(status_code=404, detail="Order not found")
-        
-    order_copy = order_dict.copy()
-    order_copy["items"] = [OrderItem(**item) for item in order_dict["items"]]
-    return Order(**order_copy)
+    return orders[index]
 
 @app.post("/orders", response_model=Order, status_code=201)
-def create_order(order_data: Order):
+async def create_order(order_data: Order, background_tasks: BackgroundTasks):
     order_dict = order_data.dict()
     order_dict["id"] = str(uuid.uuid4())
     order_dict["orderDate"] = datetime.now()
@@ -549,44 +867,54 @@ def create_order(order_data: Order):
     total_price = 0
     processed_items = []
     inventory_adjustments = []
+    requested = defaultdict(int)
     
+    order_id = order_dict["id"]
     for i, item_data in enumerate(order_data.items):
         item_dict = item_data.dict()
-        item_dict["orderId"] = order_dict["id"]
+        item_dict["orderId"] = order_id
         item_dict["id"] = str(uuid.uuid4())
+        inventory_item_id = item_data.inventoryItemId
+        quantity = item_data.quantity
         
-        inv_index = next((idx for idx, inv in enumerate(inventory_items) if inv["id"] == item_data.inventoryItemId), None)
+        inv_index = inventory_by_id.get(inventory_item_id)
         if inv_index is None:
-            raise HTTPException(status_code=404, detail=f"Inventory item {item_data.inventoryItemId} for order item {i+1} not found")
+            raise HTTPException(status_code=404, detail=f"Inventory item {inventory_item_id} for order item {i+1} not found")
         
         inventory_item = inventory_items[inv_index]
         
         if inventory_item["variety"] != item_data.variety:
-            raise HTTPException(status_code=400, detail=f"Variety mismatch for inventory item {item_data.inventoryItemId}")
+            raise HTTPException(status_code=400, detail=f"Variety mismatch for inventory item {inventory_item_id}")
             
-        try:
-            adjust_inventory(item_data.inventoryItemId, -item_data.quantity, f"Order {order_dict['id']}")
-            inventory_adjustments.append((item_data.inventoryItemId, item_data.quantity))
-        except HTTPException as e:
-            for adj_item_id, adj_qty in inventory_adjustments:
-                try: adjust_inventory(adj_item_id, adj_qty, f"Reverted failed order {order_dict['id']}")
-                except Exception as revert_e: print(f"Error reverting inventory: {revert_e}")
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {item_data.variety} (Item ID: {item_data.inventoryItemId}): {e.detail}")
+        total_requested = requested[inventory_item_id] + quantity
+        requested[inventory_item_id] = total_requested
+        if total_requested > inventory_item["trayCount"]:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {item_data.variety} (Item ID: {inventory_item_id}): {inventory_item['trayCount']} trays available")
+        inventory_adjustments.append((inventory_item_id, -quantity, f"Order {order_id}"))
         
-        item_price = item_data.quantity * (item_data.price_per_tray or 10.0)
-        total_price += item_price
-        item_dict["price_per_tray"] = item_data.price_per_tray or 10.0
+        variety = variety_by_name.get(item_data.variety)
+        item_dict["variety_id"] = variety["id"] if variety else None
+
+        price_per_tray = item_data.price_per_tray or 10.0
+        total_price += quantity * price_per_tray
+        item_dict["price_per_tray"] = price_per_tray
         processed_items.append(item_dict)
         
+    # Every item has been validated, so apply all stock changes in one pass
+    adjust_inventory_bulk(inventory_adjustments, background_tasks=background_tasks)
+
     order_dict["items"] = processed_items
     order_dict["total_price"] = round(total_price, 2)
     order_dict["status"] = "pending"
 
-    orders.append(order_dict)
-    
-    order_copy = order_dict.copy()
-    order_copy["items"] = [OrderItem(**item) for item in order_dict["items"]]
-    return Order(**order_copy)
+    # Validate once on write; reads serve the stored model as-is
+    order = Order(**order_dict)
+    orders_by_id[order.id] = len(orders)
+    orders.append(order)
+    kpis.order_created(order)
+    bump_data_version()
+    order_sales.append(order)
+    return order
 
 from fastapi import Body
 
@@ -595,25 +923,27 @@ class StatusUpdate(BaseModel):
     status: str
 
 @app.put("/orders/{order_id}", response_model=Order)
-def update_order_status(order_id: str, status_update: StatusUpdate):
+async def update_order_status(order_id: str, status_update: StatusUpdate, background_tasks: BackgroundTasks):
     status_val = status_update.status
     valid_statuses = ["pending", "confirmed", "completed", "cancelled"]
     if status_val not in valid_statuses:
         raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {valid_statuses}")
         
-    index = next((i for i, o in enumerate(orders) if o["id"] == order_id), None)
+    index = orders_by_id.get(order_id)
     if index is None:
         raise HTTPException(status_code=404, detail="Order not found")
         
-    original_status = orders[index]["status"]
+    order = orders[index]
+    original_status = order.status
     
     if status_val == "cancelled" and original_status != "cancelled":
-        order_items_list = orders[index]["items"]
-        for item_dict in order_items_list:
-            try:
-                adjust_inventory(item_dict["inventoryItemId"], item_dict["quantity"], f"Order {order_id} cancelled")
-            except HTTPException as e:
-                print(f"Error adjusting inventory on cancellation for item {item_dict['inventoryItemId']}: {e.detail}")
+        restock = []
+        for item in order.items:
+            if item.inventoryItemId not in inventory_by_id:
+                print(f"Error adjusting inventory on cancellation for item {item.inventoryItemId}: not found")
+                continue
+            restock.append((item.inventoryItemId, item.quantity, f"Order {order_id} cancelled"))
+        adjust_inventory_bulk(restock, background_tasks=background_tasks)
         print(f"Order {order_id} cancelled. Inventory adjusted.")
         
     elif status_val == "confirmed" and original_status == "pending":
@@ -622,16 +952,18 @@ def update_order_status(order_id: str, status_update: StatusUpdate):
     elif status_val == "completed" and original_status != "completed":
         print(f"Order {order_id} marked as completed.")
 
-    orders[index]["status"] = status_val
-    
-    order_copy = orders[index].copy()
-    order_copy["items"] = [OrderItem(**item) for item in order_copy["items"]]
-    return Order(**order_copy)
+    # Evict under the old status before it changes
+    kpis.evict_expired()
+    order.status = status_val
+    kpis.order_status_changed(order, original_status)
+    bump_data_version()
+    order_sales.set_status(index, status_val)
+    return order
 
 @app.delete("/orders/{order_id}", status_code=204)
-def cancel_order(order_id: str):
+async def cancel_order(order_id: str, background_tasks: BackgroundTasks):
     try:
-        update_order_status(order_id, StatusUpdate(status="cancelled"))
+        await update_order_status(order_id, StatusUpdate(status="cancelled"), background_tasks)
     except HTTPException as e:
         if e.status_code == 404:
             raise HTTPException(status_code=404, detail="Order not found")
@@ -641,195 +973,344 @@ def cancel_order(order_id: str):
 
 # --- Forecasting API Routes ---
 
-# In-memory storage for generated forecasts
+# In-memory storage for generated forecasts, keyed by horizon in weeks
 forecasts_cache = {}
+FORECAST_TTL = timedelta(hours=int(os.getenv("FORECAST_TTL_HOURS", 6)))
+
+# Prophet fits run in a separate process so they never hold up request handling
+forecast_executor: Optional[ProcessPoolExecutor] = None
+forecast_refreshes: Dict[int, asyncio.Future] = {}
+
+def start_forecast_executor():
+    global forecast_executor
+    # Spawn rather than the platform default: on Linux that is fork (until 3.14), and
+    # forking an API process that already has threads can deadlock. The spawned worker
+    # re-imports main (rebuilding the mock data, but not serving) before its first fit
+    forecast_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+def stop_forecast_executor():
+    if forecast_executor is not None:
+        forecast_executor.shutdown(wait=False, cancel_futures=True)
+
+def _store_forecast(weeks: int, future: asyncio.Future):
+    forecast_refreshes.pop(weeks, None)
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        print(f"Forecast refresh failed: {future.exception()}")
+        return
+    forecasts_cache[weeks] = future.result().dict()
+
+# Fitted Prophet models keyed by a hash of their training data, so different
+# horizons (and restarts, via the on-disk copy) reuse one fit
+PROPHET_MODEL_CACHE_SIZE = 8
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache"))
+prophet_models: "OrderedDict[str, Prophet]" = OrderedDict()
+prophet_models_lock = threading.Lock()
+
+def _prune_model_cache():
+    # Keep only the most recently used models on disk, matching the in-memory LRU size.
+    # Hashes change as orders move through the window (and mock data changes on every
+    # restart), so files for older hashes would otherwise pile up forever
+    try:
+        paths = [
+            os.path.join(MODEL_CACHE_DIR, name)
+            for name in os.listdir(MODEL_CACHE_DIR)
+            if name.startswith("prophet-") and name.endswith(".json")
+        ]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[PROPHET_MODEL_CACHE_SIZE:]:
+            os.remove(path)
+    except OSError as e:
+        print(f"Failed to prune forecast model cache: {e}")
+
+def get_fitted_prophet(df: pd.DataFrame) -> "Prophet":
+    # Imported here so only the forecast worker process pays for loading Prophet/cmdstanpy
+    from prophet import Prophet
+    from prophet.serialize import model_to_json, model_from_json
+
+    sales_hash = hashlib.blake2b(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes(), digest_size=16).hexdigest()
+    with prophet_models_lock:
+        model = prophet_models.get(sales_hash)
+        if model is not None:
+            prophet_models.move_to_end(sales_hash)
+            return model
+
+    model_path = os.path.join(MODEL_CACHE_DIR, f"prophet-{sales_hash}.json")
+    try:
+        with open(model_path) as f:
+            model = model_from_json(f.read())
+        os.utime(model_path) # Mark as recently used so pruning keeps it
+    except (OSError, ValueError):
+        model = Prophet(daily_seasonality=True, yearly_seasonality=True)
+        model.fit(df)
+        try:
+            os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+            with open(model_path, "w") as f:
+                f.write(model_to_json(model))
+        except OSError as e:
+            print(f"Failed to persist forecast model: {e}")
+        _prune_model_cache()
+
+    with prophet_models_lock:
+        prophet_models[sales_hash] = model
+        if len(prophet_models) > PROPHET_MODEL_CACHE_SIZE:
+            prophet_models.popitem(last=False)
+    return model
 
 @app.get("/forecast", response_model=Forecast)
-def get_demand_forecast(weeks: int = 4):
+async def get_demand_forecast(response: Response, weeks: int = 4):
     # Use today's date as the start
     start_date = date.today()
     end_date = start_date + timedelta(weeks=weeks)
-    cache_key = f"{start_date.isoformat()}-{weeks}"
-    # Return cached if available
-    if cache_key in forecasts_cache:
-        return Forecast(**forecasts_cache[cache_key])
-    # Prepare historical data
-    historical_days = 60
-    sales_records = get_historical_sales(days=historical_days)
-    # Build DataFrame for Prophet
-    df = pd.DataFrame([
-        {"ds": rec.date, "y": rec.totalTraysSold}
-        for rec in sales_records
-    ])
+    # Return cached if it is still fresh
+    cached = forecasts_cache.get(weeks)
+    if cached and cached["periodStart"] == start_date and datetime.now() - cached["createdAt"] < FORECAST_TTL:
+        return cached
+    # Start a refit unless one is already running for this horizon
+    refresh = forecast_refreshes.get(weeks)
+    if refresh is None:
+        historical_days = 60
+        daily_sales = daily_completed_sales(historical_days)
+        df = daily_sales.rename_axis("ds").reset_index(name="y")
+        refresh = asyncio.get_running_loop().run_in_executor(forecast_executor, _build_forecast, df, start_date, end_date, weeks)
+        refresh.add_done_callback(lambda f: _store_forecast(weeks, f))
+        forecast_refreshes[weeks] = refresh
+    # Serve the stale forecast while the refit completes
+    if cached:
+        response.status_code = 202
+        return cached
+    # Nothing to fall back on yet, so wait for the first fit
+    return await asyncio.shield(refresh)
+
+def _average_predictions(df: pd.DataFrame, start_date: date, weeks: int) -> List[ForecastPoint]:
+    # Flat forecast at the historical daily average
+    avg = round(float(df["y"].mean()), 1) if not df.empty else 0
+    dates = (np.datetime64(start_date, "D") + np.arange(weeks * 7)).tolist()
+    return [ForecastPoint(date=d, predictedTrays=avg) for d in dates]
+
+def _build_forecast(df: pd.DataFrame, start_date: date, end_date: date, weeks: int) -> Forecast:
     predictions: List[ForecastPoint] = []
     try:
         if len(df) >= 2:
-            model = Prophet(daily_seasonality=True, yearly_seasonality=True)
-            model.fit(df)
+            model = get_fitted_prophet(df)
             future = model.make_future_dataframe(periods=weeks * 7)
-            forecast_df = model.predict(future)
+            forecast_df = model.predict(future)[["ds", "yhat"]]
             # Filter to prediction period
-            mask = (forecast_df["ds"].dt.date >= start_date) & (forecast_df["ds"].dt.date <= end_date)
-            for _, row in forecast_df.loc[mask].iterrows():
-                predictions.append(
-                    ForecastPoint(date=row["ds"].date(), predictedTrays=round(row["yhat"], 1))
-                )
+            ds = forecast_df["ds"]
+            mask = (ds >= pd.Timestamp(start_date)) & (ds < pd.Timestamp(end_date) + pd.Timedelta(days=1))
+            sub = forecast_df.loc[mask]
+            dates = sub["ds"].to_numpy().astype("datetime64[D]").tolist()
+            yhats = np.round(sub["yhat"].to_numpy(), 1).tolist()
+            predictions = [ForecastPoint(date=d, predictedTrays=y) for d, y in zip(dates, yhats)]
         # Fallback if not enough data
         if not predictions:
-            avg = df["y"].mean() if not df.empty else 0
-            for i in range(weeks * 7):
-                pred_date = start_date + timedelta(days=i)
-                predictions.append(ForecastPoint(date=pred_date, predictedTrays=round(avg, 1)))
+            predictions = _average_predictions(df, start_date, weeks)
     except Exception as e:
         print(f"Forecasting error: {e}")
         # Fallback to simple average
-        avg = df["y"].mean() if not df.empty else 0
-        predictions = [ForecastPoint(date=start_date + timedelta(days=i), predictedTrays=round(avg, 1)) for i in range(weeks * 7)]
-    # Build result and cache
-    forecast_result = Forecast(periodStart=start_date, periodEnd=end_date, predictions=predictions)
-    forecasts_cache[cache_key] = forecast_result.dict()
-    return forecast_result
+        predictions = _average_predictions(df, start_date, weeks)
+    return Forecast(periodStart=start_date, periodEnd=end_date, predictions=predictions)
+
+def daily_completed_sales(days: int) -> pd.Series:
+    # Trays sold per day from completed orders, indexed by (midnight) date
+    end_hist_date = pd.Timestamp(datetime.now())
+    start_hist_date = end_hist_date - pd.Timedelta(days=days)
+    df = order_sales.frame
+    mask = (df["status"] == "completed") & (df["orderDate"] >= start_hist_date) & (df["orderDate"] <= end_hist_date)
+    completed = df.loc[mask]
+    return completed.groupby(completed["orderDate"].dt.normalize())["quantity"].sum()
 
 # Endpoint to get historical sales data (can be used by forecast chart)
 @app.get("/historical-sales", response_model=List[SalesRecord])
-def get_historical_sales(days: int = 90):
-    sales_by_date = defaultdict(int)
-    end_hist_date = datetime.now()
-    start_hist_date = end_hist_date - timedelta(days=days)
-    
-    for order_dict in orders:
-         if order_dict["status"] == "completed": # Only completed orders
-            order_date = order_dict["orderDate"]
-            if start_hist_date <= order_date <= end_hist_date:
-                order_day = order_date.date()
-                trays_in_order = sum(item["quantity"] for item in order_dict["items"])
-                sales_by_date[order_day] += trays_in_order
-                
-    sales_records = [
-        SalesRecord(date=d, totalTraysSold=count)
-        for d, count in sorted(sales_by_date.items())
+async def get_historical_sales(days: int = 90):
+    daily_sales = daily_completed_sales(days)
+    return [
+        SalesRecord(date=day.date(), totalTraysSold=int(count))
+        for day, count in daily_sales.items()
     ]
-    return sales_records
-    
+
 
 # --- END Forecasting API Routes ---
 
 
 
-@app.get("/dashboard-data")
-def get_dashboard_data():
-    # Calculate KPIs for the dashboard
-    
-    # Total trays in production (from plantings)
-    growing_trays = sum(p["tray_count"] for p in plantings if p["status"] in ["planted", "growing"])
-    
-    # Total trays in storage (from inventory)
-    storage_trays = sum(i["trayCount"] for i in inventory_items if i["status"] == "in-storage")
-    
-    # Average yield per tray (from harvests)
-    total_yield = sum(h["actual_yield"] for h in harvests)
-    total_harvested_trays = sum(
-        p["tray_count"] for p in plantings 
-        if p["id"] in [h["planting_id"] for h in harvests]
+# --- Dashboard Aggregation Kernels ---
+# Typed-array in, typed-array out; the per-row loops run inside NumPy's C code
+
+variety_expected_yield = np.array([v["expected_yield_per_tray"] for v in varieties], dtype=np.float64)
+
+def agg_yields(variety_slots: np.ndarray, yields: np.ndarray, trays: np.ndarray, n_varieties: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Total yield and tray count per variety slot
+    totals = np.bincount(variety_slots, weights=yields, minlength=n_varieties)
+    tray_counts = np.bincount(variety_slots, weights=trays, minlength=n_varieties)
+    return totals, tray_counts
+
+def compute_performance(totals: np.ndarray, tray_counts: np.ndarray, expected: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Yield per tray, and that as a percentage of the expected yield (0 where undefined)
+    yield_per = np.zeros_like(totals)
+    np.divide(totals, tray_counts, out=yield_per, where=tray_counts > 0)
+    performance = np.zeros_like(totals)
+    np.divide(yield_per, expected, out=performance, where=expected > 0)
+    return yield_per, performance * 100
+
+def agg_daily_demand(variety_slots: np.ndarray, quantities: np.ndarray, n_varieties: int, days: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Mask of varieties ordered at all, and their average daily demand over the window
+    ordered = np.bincount(variety_slots, minlength=n_varieties) > 0
+    daily = np.bincount(variety_slots, weights=quantities, minlength=n_varieties) / days
+    return ordered, daily
+
+def rank_top_varieties() -> List[dict]:
+    # Top performing varieties by yield, from the harvest columns
+    total_yields, tray_totals = agg_yields(
+        harvests_df["variety_slot"].to_numpy(),
+        harvests_df["actual_yield"].to_numpy(),
+        harvests_df["tray_count"].to_numpy(),
+        len(varieties),
     )
-    avg_yield_per_tray = total_yield / total_harvested_trays if total_harvested_trays > 0 else 0
-    
-    # Revenue in the last 30 days (from orders)
-    recent_orders_list = [o for o in orders if o["orderDate"] > datetime.now() - timedelta(days=30) and o["status"] != "cancelled"]
-    recent_revenue = sum(o["total_price"] or 0 for o in recent_orders_list)
-    
-    # Top performing varieties by yield (from harvests)
-    variety_yields = defaultdict(lambda: {"total_yield": 0, "tray_count": 0})
-    for h in harvests:
-        planting = next((p for p in plantings if p["id"] == h["planting_id"]), None)
-        if planting: variety_yields[planting["variety_id"]]["total_yield"] += h["actual_yield"]
-        if planting: variety_yields[planting["variety_id"]]["tray_count"] += planting["tray_count"]
+    yield_per, performance = compute_performance(total_yields, tray_totals, variety_expected_yield)
+
+    top_varieties = [
+        {
+            "id": varieties[slot]["id"],
+            "name": varieties[slot]["name"],
+            "yield_per_tray": round(float(yield_per[slot]), 2),
+            "expected_yield_per_tray": varieties[slot]["expected_yield_per_tray"],
+            "performance": round(float(performance[slot]), 1)
+        }
+        for slot in np.flatnonzero(tray_totals > 0).tolist()
+    ]
+    # Only the top 5 are returned, so select them rather than sorting everything
+    return heapq.nlargest(5, top_varieties, key=lambda x: x["yield_per_tray"])
+
+# Harvests and the plantings they came from don't change after startup, so the
+# ranking is computed once here rather than on every dashboard refresh
+top_varieties = rank_top_varieties()
+
+# Precomputed dashboard body, serialized once: (JSON bytes, data version, etag).
+# Rebuilt on the first read after a write bumps the data version, and every
+# DASHBOARD_REFRESH_SECONDS by a background task (the time windows and planting
+# statuses move on their own)
+DASHBOARD_REFRESH_SECONDS = 60
+_dashboard_state = (b"", -1, None)
+dashboard_refresher: Optional[asyncio.Task] = None
+
+def _recompute_dashboard():
+    global _dashboard_state
+    now = datetime.now()
+    refresh_planting_statuses(now)
+    body = orjson.dumps(compute_dashboard(now), option=orjson.OPT_SERIALIZE_NUMPY)
+    etag = f'W/"{_data_version}-{int(now.timestamp())}"'
+    _dashboard_state = (body, _data_version, etag)
+
+async def _periodic_dashboard_refresh():
+    while True:
+        await asyncio.sleep(DASHBOARD_REFRESH_SECONDS)
+        try:
+            _recompute_dashboard()
+        except Exception as e:
+            print(f"Dashboard refresh failed: {e}")
+
+async def start_dashboard_refresher():
+    global dashboard_refresher
+    _recompute_dashboard()
+    dashboard_refresher = asyncio.create_task(_periodic_dashboard_refresh())
+
+async def stop_dashboard_refresher():
+    if dashboard_refresher is not None:
+        dashboard_refresher.cancel()
+
+@app.get("/dashboard-data", response_class=ORJSONResponse)
+async def get_dashboard_data(request: Request):
+    if _dashboard_state[1] != _data_version:
+        _recompute_dashboard()
+    body, _, etag = _dashboard_state
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def compute_dashboard(now: datetime) -> dict:
+    # Reuse one clock reading for every window below
+    cutoff_30 = now - timedelta(days=30)
+    cutoff_60 = now - timedelta(days=60)
+    now64 = np.datetime64(now, "s")
+
+    # KPIs come from the running totals in KPIState
+    avg_yield_per_tray = kpis.total_yield / kpis.harvested_trays if kpis.harvested_trays > 0 else 0
+    recent_revenue, recent_order_count = kpis.recent_totals()
     
-    top_varieties = []
-    for variety_id, data in variety_yields.items():
-        variety = next((v for v in varieties if v["id"] == variety_id), None)
-        if not variety: continue
-        if data["tray_count"] > 0 and variety["expected_yield_per_tray"] > 0:
-            yield_per = data["total_yield"] / data["tray_count"]
-            performance = round((yield_per / variety["expected_yield_per_tray"]) * 100, 1)
-            top_varieties.append({
-                "id": variety_id,
-                "name": variety["name"],
-                "yield_per_tray": round(yield_per, 2),
-                "expected_yield_per_tray": variety["expected_yield_per_tray"],
-                "performance": performance
-            })
-        elif data["tray_count"] > 0: # Handle zero expected yield case
-             top_varieties.append({
-                "id": variety_id,
-                "name": variety["name"],
-                "yield_per_tray": round(data["total_yield"] / data["tray_count"], 2),
-                "expected_yield_per_tray": variety["expected_yield_per_tray"],
-                "performance": 0 # Or None, or some indicator
-            })
+    n_varieties = len(varieties)
+
+    # 30-day harvest count, straight off the harvest columns
+    harvests_30 = int((harvests_df["harvest_date"] > cutoff_30).sum())
     
-    top_varieties.sort(key=lambda x: x["yield_per_tray"], reverse=True)
+    # Upcoming harvests (from plantings): mask the planting columns, pick the next 5
+    # by date, then resolve each one's variety with a single lookup
+    expected_dates = planting_columns.expected_dates
+    upcoming = np.flatnonzero((planting_columns.statuses == "growing") & (expected_dates > now64))
+    upcoming = upcoming[np.argsort(expected_dates[upcoming], kind="stable")[:5]]
+    upcoming_harvests = [upcoming_harvest(plantings[i]) for i in upcoming.tolist()]
     
-    # Upcoming harvests (from plantings)
-    upcoming_harvests = [
+    # Forecast demand based on historical orders; cancelled and out-of-window
+    # orders are dropped before any item-level work
+    order_sales_df = order_sales.frame
+    active_mask = (
+        (order_sales_df["status"].to_numpy() != "cancelled")
+        & (order_sales_df["orderDate"].to_numpy() > np.datetime64(cutoff_60))
+    )
+    active_orders = [orders[i] for i in np.flatnonzero(active_mask).tolist()]
+    # Items carry their variety id from ingest, so no name lookups here
+    active_items = [item for o in active_orders for item in o.items if item.variety_id is not None]
+    demand_slots = [variety_slot[item.variety_id] for item in active_items]
+    demand_quantities = [item.quantity for item in active_items]
+
+    ordered, daily_demand = agg_daily_demand(
+        np.asarray(demand_slots, dtype=np.int64),
+        np.asarray(demand_quantities, dtype=np.float64),
+        n_varieties,
+        60,
+    )
+
+    demand_forecast_list = [
         {
-            "id": p["id"],
-            "variety": next((v["name"] for v in varieties if v["id"] == p["variety_id"]), "Unknown"),
-            "expected_harvest_date": p["expected_harvest_date"],
-            "tray_count": p["tray_count"],
-            "expected_yield": p["tray_count"] * next((v["expected_yield_per_tray"] for v in varieties if v["id"] == p["variety_id"]), 0)
+            "id": varieties[slot]["id"],
+            "name": varieties[slot]["name"],
+            "daily_demand": round(float(daily_demand[slot]), 2),
+            "weekly_demand": round(float(daily_demand[slot]) * 7, 2),
+            "monthly_demand": round(float(daily_demand[slot]) * 30, 2)
         }
-        for p in plantings
-        if p["status"] == "growing" and p["expected_harvest_date"] > datetime.now()
+        for slot in np.flatnonzero(ordered).tolist()
     ]
-    upcoming_harvests.sort(key=lambda x: x["expected_harvest_date"])
-    
-    # Forecast demand based on historical orders
-    variety_demand = {}
-    for order_dict in orders:
-        if order_dict["status"] == "cancelled": continue # Exclude cancelled orders from forecast
-        order_date = order_dict["orderDate"]
-        if order_date > datetime.now() - timedelta(days=60):
-            for item_dict in order_dict["items"]:
-                # Need variety ID. Let's find it via name for simplicity (less robust)
-                variety_name = item_dict["variety"]
-                variety = next((v for v in varieties if v["name"] == variety_name), None)
-                if not variety: continue 
-                variety_id = variety["id"]
-                
-                if variety_id not in variety_demand:
-                    variety_demand[variety_id] = {"total_quantity": 0}
-                variety_demand[variety_id]["total_quantity"] += item_dict["quantity"]
-    
-    demand_forecast_list = []
-    for variety_id, data in variety_demand.items():
-        daily = data["total_quantity"] / 60
-        variety = next((v for v in varieties if v["id"] == variety_id), None)
-        if variety:
-            demand_forecast_list.append({
-                "id": variety_id,
-                "name": variety["name"],
-                "daily_demand": round(daily, 2),
-                "weekly_demand": round(daily * 7, 2),
-                "monthly_demand": round(daily * 30, 2)
-            })
     
     demand_forecast_list.sort(key=lambda x: x["monthly_demand"], reverse=True)
     
     return {
         "kpis": {
-            "active_trays": growing_trays,
-            "storage_trays": storage_trays,
+            "active_trays": kpis.growing_trays,
+            "storage_trays": kpis.storage_trays,
             "avg_yield_per_tray": round(avg_yield_per_tray, 2),
             "recent_revenue": round(recent_revenue, 2),
-            "harvests_last_30_days": len([h for h in harvests if h["harvest_date"] > datetime.now() - timedelta(days=30)]),
-            "orders_last_30_days": len(recent_orders_list)
+            "harvests_last_30_days": harvests_30,
+            "orders_last_30_days": recent_order_count
         },
-        "top_varieties": top_varieties[:5],
-        "upcoming_harvests": upcoming_harvests[:5],
+        "top_varieties": top_varieties,
+        "upcoming_harvests": upcoming_harvests,
         "demand_forecast": demand_forecast_list
     }
 
+def upcoming_harvest(p: dict) -> dict:
+    variety = variety_by_id.get(p["variety_id"])
+    return {
+        "id": p["id"],
+        "variety": variety["name"] if variety else "Unknown",
+        "expected_harvest_date": p["expected_harvest_date"],
+        "tray_count": p["tray_count"],
+        "expected_yield": p["tray_count"] * (variety["expected_yield_per_tray"] if variety else 0)
+    }
+
+ONE_DAY = timedelta(days=1)
+
 # Add PlantingCreate model for new plantings
 class PlantingCreate(BaseModel):
     variety_id: int
@@ -839,20 +1320,23 @@ class PlantingCreate(BaseModel):
 
 # Add endpoint to create a new planting
 @app.post("/plantings", response_model=TrayPlanting, status_code=201)
-def create_planting(planting_data: PlantingCreate):
+async def create_planting(planting_data: PlantingCreate):
+    global _next_planting_id
     # Lookup variety
-    variety = next((v for v in varieties if v["id"] == planting_data.variety_id), None)
+    variety = variety_by_id.get(planting_data.variety_id)
     if not variety:
         raise HTTPException(status_code=404, detail="Variety not found")
     # Calculate expected harvest and initial status
+    now = datetime.now()
     expected_date = planting_data.plant_date + timedelta(days=variety["grow_cycle_days"])
     status = "planted"
-    if planting_data.plant_date < datetime.now() - timedelta(days=1):
+    if planting_data.plant_date < now - ONE_DAY:
         status = "growing"
-    if expected_date <= datetime.now():
+    if expected_date <= now:
         status = "ready"
     # Generate new ID
-    new_id = max((p["id"] for p in plantings), default=0) + 1
+    new_id = _next_planting_id
+    _next_planting_id += 1
     planting_dict = {
         "id": new_id,
         "variety_id": planting_data.variety_id,
@@ -862,7 +1346,12 @@ def create_planting(planting_data: PlantingCreate):
         "tray_count": planting_data.tray_count
     }
     plantings.append(planting_dict)
-    return TrayPlanting(**planting_dict)
+    if status in ["planted", "growing"]:
+        kpis.growing_trays += planting_dict["tray_count"]
+    index_planting(planting_dict)
+    bump_data_version()
+    # Every field was built above from validated input, so skip re-validation
+    return TrayPlanting.model_construct(**planting_dict)
 
 # Run the app with: uvicorn main:app --reload
 if __name__ == "__main__":
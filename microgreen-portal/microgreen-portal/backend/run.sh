@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-uvicorn main:app --reload --host 0.0.0.0 --port 8000 
\ No newline at end of file
+uvicorn main:app --reload --loop uvloop --http httptools --host 0.0.0.0 --port 8000 
\ No newline at end of file
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime
+
+from fastapi import BackgroundTasks
+
+import main
+
+
+def assert_indexes_match_rescan():
+    by_id = {}
+    by_variety = {}
+    for idx, item in enumerate(main.inventory_items):
+        by_id[item["id"]] = idx
+        by_variety.setdefault(item["variety"], []).append(idx)
+    assert main.inventory_by_id == by_id
+    # Moving the last item out of a variety leaves an empty list behind, which is harmless
+    assert {v: idxs for v, idxs in main.inventory_by_variety.items() if idxs} == by_variety
+    stored = sum(i["trayCount"] for i in main.inventory_items if i["status"] == "in-storage")
+    assert main.kpis.storage_trays == stored
+
+
+def other_variety(name: str) -> str:
+    return next(v["name"] for v in main.varieties if v["name"] != name)
+
+
+def test_create_keeps_indexes_in_sync():
+    item = main.InventoryItem(variety=main.varieties[0]["name"], trayCount=3, harvestDate=datetime.now(), status="in-storage")
+    created = asyncio.run(main.create_inventory_item(item, BackgroundTasks()))
+
+    assert_indexes_match_rescan()
+    assert main.inventory_items[main.inventory_by_id[created.id]]["id"] == created.id
+
+
+def test_update_variety_moves_item_between_variety_buckets():
+    item = main.inventory_items[0]
+    new_variety = other_variety(item["variety"])
+    old_variety = item["variety"]
+
+    asyncio.run(main.update_inventory_item(item["id"], main.InventoryItem(**{**item, "variety": new_variety})))
+
+    assert_indexes_match_rescan()
+    in_new = asyncio.run(main.get_inventory_items(variety=new_variety))
+    in_old = asyncio.run(main.get_inventory_items(variety=old_variety))
+    assert item["id"] in {i["id"] for i in in_new}
+    assert item["id"] not in {i["id"] for i in in_old}
+
+
+def test_update_status_moves_trays_out_of_storage():
+    item = next(i for i in main.inventory_items if i["status"] == "in-storage")
+
+    asyncio.run(main.update_inventory_item(item["id"], main.InventoryItem(**{**item, "status": "sold"})))
+
+    assert_indexes_match_rescan()
+
+
+def test_delete_shifts_later_positions():
+    middle = main.inventory_items[len(main.inventory_items) // 2]["id"]
+
+    asyncio.run(main.delete_inventory_item(middle, BackgroundTasks()))
+
+    assert middle not in main.inventory_by_id
+    assert_indexes_match_rescan()
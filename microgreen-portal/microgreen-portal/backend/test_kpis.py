@@ -0,0 +1,46 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import BackgroundTasks
+
+import main
+
+
+def rescan_recent_totals():
+    cutoff = datetime.now() - main.RECENT_WINDOW
+    counted = [o for o in main.orders if o.orderDate > cutoff and o.status != "cancelled"]
+    return sum(o.total_price or 0 for o in counted), len(counted)
+
+
+def set_status(order_id: str, status: str):
+    asyncio.run(main.update_order_status(order_id, main.StatusUpdate(status=status), BackgroundTasks()))
+
+
+def oldest_recent_order():
+    if not main.kpis.recent_orders:
+        pytest.skip("no mock orders inside the recent window")
+    _, order_id = main.kpis.recent_orders[0]
+    return main.orders[main.orders_by_id[order_id]]
+
+
+def age_past_window(order):
+    # Push the oldest tracked order just past the cutoff without letting the
+    # running totals evict it yet
+    order.orderDate = datetime.now() - main.RECENT_WINDOW - timedelta(seconds=1)
+    main.kpis.recent_orders[0] = (order.orderDate, order.id)
+
+
+@pytest.mark.parametrize("before, after", [("cancelled", "pending"), ("pending", "cancelled")])
+def test_status_change_at_window_edge_matches_rescan(before, after):
+    order = oldest_recent_order()
+    if order.status != before:
+        set_status(order.id, before)
+    age_past_window(order)
+
+    set_status(order.id, after)
+
+    revenue, count = main.kpis.recent_totals()
+    expected_revenue, expected_count = rescan_recent_totals()
+    assert count == expected_count
+    assert revenue == pytest.approx(expected_revenue)
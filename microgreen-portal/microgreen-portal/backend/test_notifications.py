@@ -0,0 +1,55 @@
+import asyncio
+from collections import deque
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def small_history(monkeypatch):
+    # A tiny cap so the tests can push notifications out of the history
+    monkeypatch.setattr(main, "notifications", deque(maxlen=3))
+    monkeypatch.setattr(main, "unread_notifs", {})
+
+
+def add(message: str) -> main.Notification:
+    notif = main.Notification(message=message, type="info")
+    main.add_notification(notif)
+    return notif
+
+
+def assert_unread_matches_rescan():
+    unread = asyncio.run(main.get_notifications(unread=True))
+    assert [n.id for n in unread] == [n.id for n in main.notifications if not n.is_read]
+
+
+def test_cap_eviction_drops_unread_index_entry():
+    first = add("first")
+    for i in range(3):
+        add(f"later {i}")
+
+    assert first.id not in main.unread_notifs
+    assert_unread_matches_rescan()
+
+
+def test_cap_eviction_of_read_notification():
+    first = add("first")
+    add("second")
+    asyncio.run(main.mark_notification_read(first.id))
+    for i in range(2):
+        add(f"later {i}")
+
+    assert_unread_matches_rescan()
+    assert len(main.unread_notifs) == 3
+
+
+def test_marking_evicted_notification_is_not_found():
+    first = add("first")
+    for i in range(3):
+        add(f"later {i}")
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.mark_notification_read(first.id))
+    assert exc.value.status_code == 404
@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import main
+
+
+def assert_state_matches_rescan():
+    assert main.planting_columns.statuses.tolist() == [p["status"] for p in main.plantings]
+    growing = sum(p["tray_count"] for p in main.plantings if p["status"] in ["planted", "growing"])
+    assert main.kpis.growing_trays == growing
+
+
+def plant(days_ago: int, tray_count: int = 2):
+    planting = main.PlantingCreate(
+        variety_id=main.varieties[0]["id"],
+        plant_date=datetime.now() - timedelta(days=days_ago),
+        tray_count=tray_count,
+    )
+    return asyncio.run(main.create_planting(planting))
+
+
+def test_create_planting_extends_columns():
+    # Enough inserts to outgrow the initial buffer capacity
+    created = [plant(0) for _ in range(80)]
+
+    assert_state_matches_rescan()
+    assert main.plantings[-1]["id"] == created[-1].id
+
+
+def test_roll_forward_through_growing_to_ready():
+    cycle = main.varieties[0]["grow_cycle_days"]
+    created = plant(0)
+    planting = main.planting_by_id[created.id]
+    assert planting["status"] == "planted"
+
+    main.refresh_planting_statuses(datetime.now() + timedelta(days=2))
+    assert planting["status"] == "growing"
+    assert_state_matches_rescan()
+
+    main.refresh_planting_statuses(datetime.now() + timedelta(days=cycle + 1))
+    assert planting["status"] == "ready"
+    assert_state_matches_rescan()
+
+
+def test_roll_forward_never_moves_backwards():
+    created = plant(2)
+    planting = main.planting_by_id[created.id]
+    assert planting["status"] == "growing"
+
+    # A clock behind the planting's dates must not revert it to "planted"
+    main.refresh_planting_statuses(datetime.now() - timedelta(days=5))
+    assert planting["status"] == "growing"
+    assert_state_matches_rescan()
@@ -4,7 +4,7 @@
 echo "Starting the backend server..."
 cd backend
 source venv/bin/activate
-uvicorn main:app --reload --host 0.0.0.0 --port 8000 &
+uvicorn main:app --reload --loop uvloop --http httptools --host 0.0.0.0 --port 8000 &
 BACKEND_PID=$!
 
 # Wait a moment for the backend to start